@@ -0,0 +1,176 @@
+"""Structured audit events written off the calling thread."""
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+
+OVERFLOW_DROP = "drop"
+OVERFLOW_BLOCK = "block"
+
+_logger: logging.Logger = logging.getLogger(__name__)
+
+
+class AuditLog(object):
+    """Queue JSON audit events and write them in batches from a background thread.
+
+    Parameters
+    ----------
+    writer : callable
+        Called from the background thread with a list of JSON lines. Defaults to one
+        ``sec_manager.audit`` INFO log record per event.
+    maxsize : int
+        Maximum number of events waiting to be written.
+    overflow : str
+        What to do when the queue is full: ``drop`` the event (and report how many
+        were dropped) or ``block`` the caller up to ``block_timeout`` seconds first.
+    batch_size : int
+        Maximum number of events per write.
+    flush_interval : float
+        Seconds the writer waits for more events before writing a partial batch.
+    dedupe_window : float
+        Events emitted with the same ``dedupe_key`` within this many seconds are only
+        written once. Once the window is over, the number suppressed is written either
+        with the next such event or, if none comes, in an ``audit_suppressed`` event
+        carrying the fields of the first one. At most ``maxsize`` keys are tracked at a
+        time, events with other keys are then not deduplicated.
+    """
+
+    def __init__(
+        self,
+        writer=None,
+        maxsize=10000,
+        overflow=OVERFLOW_DROP,
+        block_timeout=0.1,
+        batch_size=100,
+        flush_interval=1.0,
+        dedupe_window=60.0,
+    ):
+        if overflow not in (OVERFLOW_DROP, OVERFLOW_BLOCK):
+            raise ValueError("overflow must be {!r} or {!r}, got {!r}".format(OVERFLOW_DROP, OVERFLOW_BLOCK, overflow))
+        self.writer = writer or self._log_lines
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dedupe_window = dedupe_window
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._dedupe = {}
+
+    @staticmethod
+    def _log_lines(lines):
+        # One record per event, so that log shippers get one JSON event per line
+        for line in lines:
+            _logger.info(line)
+
+    def emit(self, event, dedupe_key=None, **fields):
+        """Queue an ``event`` with its ``fields``. Never waits on the writer unless the
+        overflow policy is ``block`` and the queue is full.
+
+        Returns
+        -------
+        bool
+            Whether the event was queued.
+        """
+        now = time.time()
+        if dedupe_key is not None:
+            suppressed = self._suppress(event, dedupe_key, now, fields)
+            if suppressed is None:
+                return False
+            if suppressed:
+                fields["suppressed"] = suppressed
+
+        record = {"ts": now, "event": event}
+        record.update(fields)
+        self._ensure_started()
+        try:
+            if self.overflow == OVERFLOW_BLOCK:
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        return True
+
+    def _suppress(self, event, dedupe_key, now, fields):
+        """Return None if the event must be suppressed, else the number suppressed and not yet reported."""
+        key = (event, dedupe_key)
+        with self._lock:
+            first_seen, suppressed, first_fields = self._dedupe.get(key, (None, 0, None))
+            if first_seen is not None and now - first_seen < self.dedupe_window:
+                self._dedupe[key] = (first_seen, suppressed + 1, first_fields)
+                return None
+            if first_seen is not None or len(self._dedupe) < self._queue.maxsize:
+                self._dedupe[key] = (now, 0, dict(fields))
+            return suppressed
+
+    def _take_suppressed(self, now, flush=False):
+        """Forget the keys whose window is over, and return an ``audit_suppressed`` event for each
+        one with suppressed events. With ``flush``, report the counts of every key.
+        """
+        records = []
+        with self._lock:
+            for key, (first_seen, suppressed, fields) in list(self._dedupe.items()):
+                expired = now - first_seen >= self.dedupe_window
+                if suppressed and (expired or flush):
+                    record = dict(fields)
+                    record.update(ts=now, event="audit_suppressed", suppressed_event=key[0], count=suppressed)
+                    records.append(record)
+                    self._dedupe[key] = (first_seen, 0, fields)
+                if expired:
+                    del self._dedupe[key]
+        return records
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sec-manager-audit", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        now = time.time()
+        records = batch + self._take_suppressed(now)
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            records.append({"ts": now, "event": "audit_dropped", "count": dropped})
+        try:
+            if records:
+                self.writer([json.dumps(record, default=str) for record in records])
+        except Exception:  # noqa: B902 - a failing writer must not kill the writer thread
+            _logger.exception("Unable to write %d audit event(s)", len(records))
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until every queued event, and every suppressed count, has been written."""
+        if self._thread is not None:
+            for record in self._take_suppressed(time.time(), flush=True):
+                self._queue.put(record)
+            self._queue.join()
+
+
+audit_log = AuditLog()
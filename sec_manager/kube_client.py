@@ -0,0 +1,63 @@
+"""Factory for the Kubernetes API client shared by the pod cleaner."""
+import logging
+import socket
+
+from kubernetes import client, config
+from urllib3.connection import HTTPConnection
+
+DEFAULT_POOL_MAXSIZE = 4
+# (connect, read) timeout in seconds passed as ``_request_timeout`` to each API call
+DEFAULT_REQUEST_TIMEOUT = (5, 60)
+
+KEEPALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+
+def load_configuration(kubeconfig=None, context=None):
+    """Load the credentials from ``kubeconfig`` if given, from the in-cluster service account otherwise.
+
+    Returns
+    -------
+    kubernetes.client.Configuration
+    """
+    configuration = client.Configuration()
+    if kubeconfig:
+        logging.info(f"Loading Kubernetes configuration from {kubeconfig}")
+        config.load_kube_config(config_file=kubeconfig, context=context, client_configuration=configuration)
+    else:
+        logging.info("Loading Kubernetes configuration")
+        config.load_incluster_config(client_configuration=configuration)
+    return configuration
+
+
+def create_api_client(kubeconfig=None, context=None, pool_maxsize=DEFAULT_POOL_MAXSIZE, keepalive=True, retries=None):
+    """Build one ``ApiClient`` to share between the listing and the deletions of a run.
+
+    Parameters
+    ----------
+    kubeconfig : str
+        Path of a kubeconfig file. The in-cluster configuration is used when not set.
+    context : str
+        Context of the kubeconfig file to use, its current context when not set.
+    pool_maxsize : int
+        Maximum number of connections kept open to the API server.
+    keepalive : bool
+        Enable TCP keepalive on the pooled connections.
+    retries : int
+        Number of retries of urllib3 on connection errors.
+
+    Returns
+    -------
+    kubernetes.client.ApiClient
+    """
+    configuration = load_configuration(kubeconfig, context)
+    configuration.connection_pool_maxsize = pool_maxsize
+    if retries is not None:
+        configuration.retries = retries
+
+    logging.debug("Initializing Kubernetes client")
+    api_client = client.ApiClient(configuration)
+    if keepalive:
+        # The client does not expose socket options, set them on the pool manager so that every
+        # connection pool it creates uses them.
+        api_client.rest_client.pool_manager.connection_pool_kw["socket_options"] = KEEPALIVE_SOCKET_OPTIONS
+    return api_client
@@ -1,40 +1,286 @@
 import argparse
 import importlib
+import json
 import logging
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from airflow import settings, version
+from airflow.stats import Stats
 from alembic.config import Config
 from alembic.runtime.migration import MigrationContext
 from alembic.script import ScriptDirectory
+from alembic.script.revision import RevisionError
+from alembic.util import CommandError
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+
+AIRFLOW_DATABASE = "airflow"
 
 
 # package_dir is path of installed airflow in your virtualenv or system (site-packages)
 # we use it to find alembic.ini file
-def spinner(timeout):
+def get_script_directory():
     package_dir = os.path.dirname(importlib.util.find_spec("airflow").origin)
     directory = os.path.join(package_dir, "migrations")
     config = Config(os.path.join(package_dir, "alembic.ini"))
     config.set_main_option("script_location", directory)
     config.set_main_option("sqlalchemy.url", settings.SQL_ALCHEMY_CONN.replace("%", "%%"))
-    script_ = ScriptDirectory.from_config(config)
-
-    with settings.engine.connect() as connection:
-        context = MigrationContext.configure(connection)
-        ticker = 0
-        while True:
-            source_heads = set(script_.get_heads())
-            db_heads = set(context.get_current_heads())
-            if source_heads == db_heads:
-                logging.info("Airflow version: {}".format(version.version))
-                logging.info("Current heads: {}".format(db_heads))
-                break
-            elif ticker >= timeout:
-                raise TimeoutError("There are still unapplied migrations after {} seconds".format(timeout))
-            ticker += 1
-            time.sleep(1)
-            logging.info("Waiting for migrations... {} second(s)".format(ticker))
+    return ScriptDirectory.from_config(config)
+
+
+def load_script_directory(script_location):
+    """Alembic scripts found in ``script_location``, for databases other than Airflow's."""
+    config = Config()
+    config.set_main_option("script_location", script_location)
+    return ScriptDirectory.from_config(config)
+
+
+def revision_distance(script_, source_heads, db_heads):
+    """Number of revisions to apply to go from ``db_heads`` to ``source_heads``.
+
+    That is the ancestors of the source heads the database hasn't applied yet, which also
+    holds when the graph has several heads the database is at only some of.
+
+    Returns None when the distance can't be computed from the alembic graph, e.g. when
+    the database is at a revision the scripts don't know about.
+    """
+    try:
+        pending = {revision.revision for revision in script_.iterate_revisions(tuple(source_heads), "base")}
+        if db_heads:
+            pending -= {revision.revision for revision in script_.iterate_revisions(tuple(db_heads), "base")}
+    except (CommandError, RevisionError):
+        return None
+    return len(pending)
+
+
+class Readiness(object):
+    """Migration state of each database, published to a readiness file and an HTTP probe.
+
+    The readiness file is only written once every database is up to date.
+    """
+
+    def __init__(self, names, ready_file=None):
+        self.ready_file = ready_file
+        self._lock = threading.Lock()
+        self._status = {name: {"ready": False, "pending_revisions": None} for name in names}
+        if ready_file and os.path.exists(ready_file):
+            os.remove(ready_file)
+
+    @property
+    def ready(self):
+        with self._lock:
+            return all(status["ready"] for status in self._status.values())
+
+    def status(self):
+        with self._lock:
+            return {name: dict(status) for name, status in self._status.items()}
+
+    def update(self, name, ready, pending_revisions):
+        with self._lock:
+            self._status[name] = {"ready": ready, "pending_revisions": pending_revisions}
+        if self.ready_file and self.ready:
+            with open(self.ready_file, "w") as fh:
+                json.dump(self.status(), fh)
+
+
+def serve_probe(readiness, port):
+    """Serve ``GET /`` answering 200 once all databases are migrated, 503 until then."""
+
+    class ProbeHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            payload = json.dumps(readiness.status()).encode()
+            self.send_response(200 if readiness.ready else 503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), ProbeHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Serving migrations readiness probe on port {}".format(server.server_port))
+    return server
+
+
+def wait_for_database(name, engine, script_, deadline, readiness, interval=1):
+    """Poll the heads of one database until they match the script heads or ``deadline`` passes.
+
+    The database not accepting connections yet, e.g. while it starts up, is waited for too.
+    """
+    started = time.monotonic()
+    while True:
+        try:
+            with engine.connect() as connection:
+                db_heads = set(MigrationContext.configure(connection).get_current_heads())
+        except DBAPIError as e:
+            error = str(e.orig)
+            readiness.update(name, False, None)
+            if time.monotonic() >= deadline:
+                raise TimeoutError("{} does not accept connections: {}".format(name, error))
+            time.sleep(interval)
+            logging.info(
+                json.dumps(
+                    {
+                        "event": "waiting_for_database",
+                        "database": name,
+                        "error": error,
+                        "elapsed_seconds": round(time.monotonic() - started),
+                    }
+                )
+            )
+            continue
+
+        source_heads = set(script_.get_heads())
+        ready = source_heads == db_heads
+        pending = 0 if ready else revision_distance(script_, source_heads, db_heads)
+        readiness.update(name, ready, pending)
+        if pending is not None:
+            Stats.gauge("migrations_spinner.pending_revisions.{}".format(name), pending)
+
+        if ready:
+            logging.info("Current heads of {}: {}".format(name, db_heads))
+            return
+        elif time.monotonic() >= deadline:
+            raise TimeoutError("Unapplied migrations on {}: {} pending revision(s)".format(name, pending))
+
+        time.sleep(interval)
+        logging.info(
+            json.dumps(
+                {
+                    "event": "waiting_for_migrations",
+                    "database": name,
+                    "pending_revisions": pending,
+                    "current_heads": sorted(db_heads),
+                    "target_heads": sorted(source_heads),
+                    "elapsed_seconds": round(time.monotonic() - started),
+                }
+            )
+        )
+
+
+def wait_for_connection(name, engine, deadline, readiness, interval=1):
+    """Wait until a database without migration scripts to check, e.g. a results backend,
+    accepts connections or ``deadline`` passes.
+    """
+    started = time.monotonic()
+    while True:
+        try:
+            with engine.connect() as connection:
+                connection.execute("SELECT 1")
+        except DBAPIError as e:
+            error = str(e.orig)
+        else:
+            readiness.update(name, True, None)
+            logging.info("{} accepts connections".format(name))
+            return
+
+        if time.monotonic() >= deadline:
+            raise TimeoutError("{} does not accept connections: {}".format(name, error))
+
+        time.sleep(interval)
+        logging.info(
+            json.dumps(
+                {
+                    "event": "waiting_for_database",
+                    "database": name,
+                    "error": error,
+                    "elapsed_seconds": round(time.monotonic() - started),
+                }
+            )
+        )
+
+
+def spinner(timeout, databases=None, ready_file=None, probe_port=None, migrations=None):
+    """Wait until the Airflow metadata database is at the heads of the Airflow migration
+    scripts, and each of ``databases`` is at the heads of its own scripts or, when it has
+    none, accepts connections.
+
+    Parameters
+    ----------
+    timeout : int
+        Seconds to wait for all the databases, checked concurrently.
+    databases : dict[str, str]
+        Extra databases to check, by name, e.g. {'tenant_a': 'postgresql://...'}.
+    migrations : dict[str, str]
+        Alembic script location of some of ``databases``, by name, ``airflow`` standing
+        for the Airflow migration scripts, e.g. {'tenant_a': 'airflow'}.
+    ready_file : str
+        File written with the status of every database once they are all migrated.
+    probe_port : int
+        Port of an HTTP readiness probe served while waiting.
+
+    Returns
+    -------
+    None
+    """
+    migrations = migrations or {}
+    unknown = set(migrations) - set(databases or {})
+    if unknown:
+        raise ValueError("Migration scripts given for unknown databases: {}".format(", ".join(sorted(unknown))))
+
+    airflow_script = get_script_directory()
+    scripts = {AIRFLOW_DATABASE: airflow_script}
+    for name, script_location in migrations.items():
+        if script_location == AIRFLOW_DATABASE:
+            scripts[name] = airflow_script
+        else:
+            scripts[name] = load_script_directory(script_location)
+
+    engines = {AIRFLOW_DATABASE: settings.engine}
+    for name, url in (databases or {}).items():
+        engines[name] = create_engine(url)
+
+    readiness = Readiness(engines, ready_file)
+    probe = serve_probe(readiness, probe_port) if probe_port is not None else None
+    deadline = time.monotonic() + timeout
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(engines), thread_name_prefix="migrations-spinner") as pool:
+            futures = {}
+            for name, engine in engines.items():
+                if name in scripts:
+                    future = pool.submit(wait_for_database, name, engine, scripts[name], deadline, readiness)
+                else:
+                    future = pool.submit(wait_for_connection, name, engine, deadline, readiness)
+                futures[future] = name
+            wait(futures)
+    finally:
+        if probe is not None:
+            probe.shutdown()
+            probe.server_close()
+        for name, engine in engines.items():
+            # The Airflow engine belongs to airflow.settings
+            if name != AIRFLOW_DATABASE:
+                engine.dispose()
+
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    timeouts = [str(error) for error in errors if isinstance(error, TimeoutError)]
+    if timeouts:
+        raise TimeoutError(
+            "There are still unready databases after {} seconds. {}".format(timeout, "; ".join(timeouts))
+        )
+    if errors:
+        raise errors[0]
+
+    logging.info("Airflow version: {}".format(version.version))
+
+
+def parse_databases(specs, value_name="SQLALCHEMY_URL"):
+    """Turn ``["name=value", ...]`` into ``{"name": "value", ...}``."""
+    databases = {}
+    for spec in specs or []:
+        name, sep, value = spec.partition("=")
+        if not sep or not name or not value:
+            raise argparse.ArgumentTypeError("Expected NAME={}, got {}".format(value_name, spec))
+        databases[name] = value
+    return databases
 
 
 def main():
@@ -42,8 +288,38 @@ def main():
     parser.add_argument(
         "--timeout", dest="timeout", default=60, type=int, help="Timeout for waiting until airflow migrations completes"
     )
+    parser.add_argument(
+        "--database",
+        dest="databases",
+        action="append",
+        help="Extra NAME=SQLALCHEMY_URL database to wait for, can be repeated",
+    )
+    parser.add_argument(
+        "--migrations",
+        dest="migrations",
+        action="append",
+        help="NAME=SCRIPT_LOCATION alembic scripts of an extra database, 'airflow' for the Airflow ones. "
+        "Extra databases without scripts are only waited for until they accept connections",
+    )
+    parser.add_argument(
+        "--ready-file", dest="ready_file", default=None, type=str, help="File written once all databases are migrated"
+    )
+    parser.add_argument(
+        "--probe-port", dest="probe_port", default=None, type=int, help="Port of an HTTP readiness probe"
+    )
     args = parser.parse_args()
-    spinner(args.timeout)
+    try:
+        databases = parse_databases(args.databases)
+        migrations = parse_databases(args.migrations, value_name="SCRIPT_LOCATION")
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    spinner(
+        args.timeout,
+        databases=databases,
+        ready_file=args.ready_file,
+        probe_port=args.probe_port,
+        migrations=migrations,
+    )
 
 
 if __name__ == "__main__":
@@ -1,59 +1,372 @@
 import argparse
+import json
 import logging
+import re
+import time
+from collections import defaultdict, namedtuple
+from datetime import datetime, timezone
 
-from kubernetes import client, config
+from kubernetes import client
 from kubernetes.client.rest import ApiException
 
+from sec_manager.audit import audit_log
+from sec_manager.kube_client import DEFAULT_POOL_MAXSIZE, DEFAULT_REQUEST_TIMEOUT, create_api_client
+
 POD_SUCCEEDED = "succeeded"
 POD_FAILED = "failed"
 POD_REASON_EVICTED = "evicted"
 POD_RESTART_POLICY_NEVER = "never"
 
+# Upper bound in seconds and label of the age buckets used by the dry-run summary
+AGE_BUCKETS = ((3600, "<1h"), (6 * 3600, "1h-6h"), (24 * 3600, "6h-1d"), (7 * 24 * 3600, "1d-7d"))
+AGE_BUCKET_OLDEST = ">7d"
+AGE_BUCKET_UNKNOWN = "unknown"
+
+
+# Compact projection of a V1Pod holding only what the cleanup policies look at. Phase, reason
+# and restart policy are lower-cased, ``completed_at`` is an epoch timestamp.
+PodRecord = namedtuple(
+    "PodRecord", ("name", "phase", "reason", "restart_policy", "completed_at", "labels", "annotations", "owner_kinds")
+)
+
+DEFAULT_PAGE_SIZE = 500
+_TIMESTAMP_FRACTION = re.compile(r"\.(\d+)")
+
+
+def _parse_timestamp(value):
+    """Epoch of an RFC 3339 timestamp, None when missing or unparseable."""
+    if not isinstance(value, str) or not value:
+        return None
+    value = value.replace("Z", "+00:00").replace("z", "+00:00")
+    # datetime.fromisoformat only accepts 3 or 6 fractional digits before Python 3.11
+    value = _TIMESTAMP_FRACTION.sub(lambda match: "." + match.group(1)[:6].ljust(6, "0"), value, count=1)
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        logging.debug("Ignoring unparseable timestamp %s", value)
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def _completed_at(metadata, status):
+    """When the pod completed, i.e. when its last container terminated.
+
+    Pods without terminated containers (evicted pods typically) fall back to the last
+    transition of their conditions, i.e. when they were stopped, and only then to their
+    start time or creation time.
+    """
+    finished = [
+        _parse_timestamp(((container.get("state") or {}).get("terminated") or {}).get("finishedAt"))
+        for container in status.get("containerStatuses") or []
+    ]
+    finished = [value for value in finished if value is not None]
+    if not finished:
+        finished = [
+            _parse_timestamp(condition.get("lastTransitionTime")) for condition in status.get("conditions") or []
+        ]
+        finished = [value for value in finished if value is not None]
+    if finished:
+        return max(finished)
+    started = _parse_timestamp(status.get("startTime"))
+    return started if started is not None else _parse_timestamp(metadata.get("creationTimestamp"))
+
+
+def project_pod(pod, label_keys=frozenset(), annotation_keys=frozenset()):
+    """Build a :class:`PodRecord` from the raw JSON of a pod.
+
+    Only the labels and annotations in ``label_keys``/``annotation_keys`` are kept, as
+    annotations in particular can be large (e.g. kubectl's last-applied-configuration).
+    """
+    metadata = pod.get("metadata") or {}
+    status = pod.get("status") or {}
+    labels = metadata.get("labels") or {}
+    annotations = metadata.get("annotations") or {}
+    return PodRecord(
+        name=metadata.get("name"),
+        phase=(status.get("phase") or "").lower(),
+        reason=(status.get("reason") or "").lower(),
+        restart_policy=((pod.get("spec") or {}).get("restartPolicy") or "").lower(),
+        completed_at=_completed_at(metadata, status),
+        labels={key: labels[key] for key in label_keys if key in labels} or None,
+        annotations={key: annotations[key] for key in annotation_keys if key in annotations} or None,
+        owner_kinds=tuple(ref.get("kind") for ref in metadata.get("ownerReferences") or ()) or None,
+    )
+
+
+def deletion_reason(pod):
+    """Return why ``pod`` is eligible for deletion (evicted, succeeded or failed), or None."""
+    if pod.reason == POD_REASON_EVICTED:
+        return POD_REASON_EVICTED
+    if pod.phase == POD_SUCCEEDED:
+        return POD_SUCCEEDED
+    if pod.phase == POD_FAILED and pod.restart_policy == POD_RESTART_POLICY_NEVER:
+        return POD_FAILED
+    return None
+
+
+def pod_age(pod, now):
+    """Seconds since the pod completed, None if unknown."""
+    if pod.completed_at is None:
+        return None
+    return now - pod.completed_at
+
+
+def age_bucket(age):
+    if age is None:
+        return AGE_BUCKET_UNKNOWN
+    for upper_bound, label in AGE_BUCKETS:
+        if age < upper_bound:
+            return label
+    return AGE_BUCKET_OLDEST
+
+
+def parse_selector(selectors):
+    """Turn ``["key=value", "key"]`` into ``{"key": "value", "key": None}``, None meaning any value."""
+    parsed = {}
+    for selector in selectors or []:
+        key, sep, value = selector.partition("=")
+        parsed[key] = value if sep else None
+    return parsed
+
+
+def _selector_matches(values, key, expected):
+    values = values or {}
+    return key in values and (expected is None or values[key] == expected)
+
+
+class CleanupPolicy(object):
+    """Select which of the completed pods get deleted.
+
+    The filters are compiled once into a list of predicates so that each pod of the
+    listing is checked with a single pass over only the filters that were configured.
 
-def delete_pod(name, namespace):
-    core_v1 = client.CoreV1Api()
+    Parameters
+    ----------
+    min_age : int
+        Keep pods that completed less than this many seconds ago.
+    include_labels, include_annotations : dict
+        Only delete pods having all of these labels/annotations. A None value matches any value.
+    exclude_labels, exclude_annotations : dict
+        Keep pods having any of these labels/annotations. A None value matches any value.
+    owner_kinds : set[str]
+        Only delete pods owned by one of these kinds, e.g. {'Job'}.
+    max_deletions : int
+        Stop after deleting this many pods.
+    """
+
+    def __init__(
+        self,
+        min_age=0,
+        include_labels=None,
+        exclude_labels=None,
+        include_annotations=None,
+        exclude_annotations=None,
+        owner_kinds=None,
+        max_deletions=None,
+    ):
+        self.max_deletions = max_deletions
+        self.label_keys = frozenset(include_labels or ()) | frozenset(exclude_labels or ())
+        self.annotation_keys = frozenset(include_annotations or ()) | frozenset(exclude_annotations or ())
+        self._filters = []
+
+        if min_age:
+            self._filters.append(lambda pod, now: (pod_age(pod, now) or 0) >= min_age)
+
+        for field, include, exclude in (
+            ("labels", include_labels, exclude_labels),
+            ("annotations", include_annotations, exclude_annotations),
+        ):
+            for key, expected in (include or {}).items():
+                self._filters.append(
+                    lambda pod, now, f=field, k=key, e=expected: _selector_matches(getattr(pod, f), k, e)
+                )
+            for key, expected in (exclude or {}).items():
+                self._filters.append(
+                    lambda pod, now, f=field, k=key, e=expected: not _selector_matches(getattr(pod, f), k, e)
+                )
+
+        if owner_kinds:
+            owner_kinds = set(owner_kinds)
+            self._filters.append(lambda pod, now: any(kind in owner_kinds for kind in pod.owner_kinds or ()))
+
+    def match(self, pod, now):
+        """Return the deletion reason of ``pod`` if the policy selects it, None otherwise."""
+        reason = deletion_reason(pod)
+        if reason is None:
+            return None
+        for pod_filter in self._filters:
+            if not pod_filter(pod, now):
+                return None
+        return reason
+
+
+def delete_pod(name, namespace, api_client=None, request_timeout=DEFAULT_REQUEST_TIMEOUT):
+    core_v1 = client.CoreV1Api(api_client)
     delete_options = client.V1DeleteOptions()
     logging.warning(f'Deleting POD "{name}" from "{namespace}" namespace. ')
-    api_response = core_v1.delete_namespaced_pod(name=name, namespace=namespace, body=delete_options)
+    api_response = core_v1.delete_namespaced_pod(
+        name=name, namespace=namespace, body=delete_options, _request_timeout=request_timeout
+    )
+
+    logging.debug(api_response)
+
 
-    logging.info(api_response)
+def list_pods(core_v1, namespace, policy, page_size=DEFAULT_PAGE_SIZE, request_timeout=DEFAULT_REQUEST_TIMEOUT):
+    """Yield a :class:`PodRecord` for each pod of ``namespace``.
 
+    The listing is fetched page by page as raw JSON instead of ``V1Pod`` models. The body
+    of one page at a time is read in full, ``page_size`` bounds it, and each pod object is
+    projected to a record as soon as the parser has built it, so neither ``V1Pod`` models
+    nor the parsed JSON tree of the pods are kept.
+
+    Timestamps that can't be parsed are treated as unknown rather than failing the listing.
+    """
+
+    def object_hook(obj):
+        if "metadata" in obj and "spec" in obj and "status" in obj:
+            return project_pod(obj, policy.label_keys, policy.annotation_keys)
+        return obj
 
-def cleanup(namespace):
-    logging.info("Loading Kubernetes configuration")
-    config.load_incluster_config()
-    logging.debug("Initializing Kubernetes client")
-    core_v1 = client.CoreV1Api()
     logging.info(f"Listing namespaced pods in namespace {namespace}. ")
-    pod_list = core_v1.list_namespaced_pod(namespace)
-
-    for pod in pod_list.items:
-        logging.info(f"Inspecting pod {pod.metadata.name}. ")
-        pod_phase = pod.status.phase.lower()
-        pod_reason = pod.status.reason.lower() if pod.status.reason else ""
-        pod_restart_policy = pod.spec.restart_policy.lower()
-
-        if (
-            pod_phase == POD_SUCCEEDED
-            or (pod_phase == POD_FAILED and pod_restart_policy == POD_RESTART_POLICY_NEVER)
-            or (pod_reason == POD_REASON_EVICTED)
-        ):
+    continue_token = None
+    while True:
+        kwargs = {"limit": page_size, "_preload_content": False, "_request_timeout": request_timeout}
+        if continue_token:
+            kwargs["_continue"] = continue_token
+        response = core_v1.list_namespaced_pod(namespace, **kwargs)
+        try:
+            page = json.load(response, object_hook=object_hook)
+        finally:
+            response.release_conn()
+
+        yield from page.get("items") or []
+
+        continue_token = (page.get("metadata") or {}).get("continue")
+        if not continue_token:
+            break
+
+
+def cleanup(namespace, policy=None, dry_run=False, api_client=None, request_timeout=DEFAULT_REQUEST_TIMEOUT):
+    """Delete the pods of ``namespace`` selected by ``policy``.
+
+    The listing and all the deletions go through ``api_client``, so they share its connection
+    pool. One is built with :func:`sec_manager.kube_client.create_api_client` when not given.
+
+    Returns
+    -------
+    dict
+        When ``dry_run`` is set, nothing is deleted and the pod names a run would delete,
+        ``max_deletions`` included, are returned indexed by (reason, age bucket). None otherwise.
+    """
+    policy = policy or CleanupPolicy()
+    api_client = api_client or create_api_client()
+    core_v1 = client.CoreV1Api(api_client)
+
+    now = time.time()
+    index = defaultdict(list)
+    deleted = 0
+
+    for pod in list_pods(core_v1, namespace, policy, request_timeout=request_timeout):
+        logging.debug("Inspecting pod %s. ", pod.name)
+        reason = policy.match(pod, now)
+
+        if reason is None:
+            logging.debug("No action taken on pod %s. ", pod.name)
+            continue
+
+        if policy.max_deletions is not None and deleted >= policy.max_deletions:
+            logging.info(f"Reached the maximum of {policy.max_deletions} deletions for this run. ")
+            break
+
+        if dry_run:
+            index[(reason, age_bucket(pod_age(pod, now)))].append(pod.name)
+            deleted += 1
+            continue
+
+        try:
+            delete_pod(pod.name, namespace, api_client=api_client, request_timeout=request_timeout)
+            deleted += 1
+            audit_log.emit("pod_deleted", pod=pod.name, namespace=namespace, reason=reason)
+        except ApiException as e:
+            logging.error(f"can't remove POD: {e}. ")
 
-            logging.info(
-                f'Deleting pod "{pod.metadata.name}" phase "{pod_phase}" '
-                f'and reason "{pod_reason}", restart policy "{pod_restart_policy}". '
-            )
+    if not dry_run:
+        audit_log.flush()
+        return None
 
-            try:
-                delete_pod(pod.metadata.name, namespace)
-            except ApiException as e:
-                logging.error(f"can't remove POD: {e}. ")
-                continue
-        logging.info(f"No action taken on pod {pod.metadata.name}. ")
+    for (reason, bucket), names in sorted(index.items()):
+        logging.info(f'Dry run: {len(names)} pod(s) with reason "{reason}" completed {bucket} ago. ')
+    return dict(index)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Clean up k8s pods in evicted/failed/succeeded states.")
     parser.add_argument("--namespace", dest="namespace", default="default", type=str, help="Namespace")
+    parser.add_argument(
+        "--kubeconfig", dest="kubeconfig", default=None, type=str, help="Kubeconfig file, in-cluster config if not set"
+    )
+    parser.add_argument("--context", dest="context", default=None, type=str, help="Kubeconfig context")
+    parser.add_argument(
+        "--pool-maxsize",
+        dest="pool_maxsize",
+        default=DEFAULT_POOL_MAXSIZE,
+        type=int,
+        help="Maximum number of connections to the API server",
+    )
+    parser.add_argument(
+        "--request-timeout",
+        dest="request_timeout",
+        default=DEFAULT_REQUEST_TIMEOUT[1],
+        type=int,
+        help="Timeout in seconds of each API call",
+    )
+    parser.add_argument(
+        "--min-age", dest="min_age", default=0, type=int, help="Keep pods completed less than this many seconds ago"
+    )
+    parser.add_argument(
+        "--include-label", dest="include_labels", action="append", help="Only delete pods with this key[=value] label"
+    )
+    parser.add_argument(
+        "--exclude-label", dest="exclude_labels", action="append", help="Keep pods with this key[=value] label"
+    )
+    parser.add_argument(
+        "--include-annotation",
+        dest="include_annotations",
+        action="append",
+        help="Only delete pods with this key[=value] annotation",
+    )
+    parser.add_argument(
+        "--exclude-annotation",
+        dest="exclude_annotations",
+        action="append",
+        help="Keep pods with this key[=value] annotation",
+    )
+    parser.add_argument(
+        "--owner-kind", dest="owner_kinds", action="append", help="Only delete pods owned by this kind, e.g. Job"
+    )
+    parser.add_argument(
+        "--max-deletions", dest="max_deletions", default=None, type=int, help="Maximum number of pods deleted per run"
+    )
+    parser.add_argument(
+        "--dry-run", dest="dry_run", action="store_true", help="Only report the pods that would be deleted"
+    )
     args = parser.parse_args()
-    cleanup(args.namespace)
+    policy = CleanupPolicy(
+        min_age=args.min_age,
+        include_labels=parse_selector(args.include_labels),
+        exclude_labels=parse_selector(args.exclude_labels),
+        include_annotations=parse_selector(args.include_annotations),
+        exclude_annotations=parse_selector(args.exclude_annotations),
+        owner_kinds=args.owner_kinds,
+        max_deletions=args.max_deletions,
+    )
+    api_client = create_api_client(kubeconfig=args.kubeconfig, context=args.context, pool_maxsize=args.pool_maxsize)
+    cleanup(
+        args.namespace,
+        policy=policy,
+        dry_run=args.dry_run,
+        api_client=api_client,
+        request_timeout=(DEFAULT_REQUEST_TIMEOUT[0], args.request_timeout),
+    )
@@ -0,0 +1,192 @@
+"""SQL query counting and N+1 detection for the security manager."""
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from sqlalchemy import event
+
+_logger: logging.Logger = logging.getLogger(__name__)
+
+UNATTRIBUTED = "<unattributed>"
+
+
+class QueryReport(object):
+    """Queries executed during one unit of work, e.g. a request or a ``sync_roles`` run."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.duration = 0.0
+        self.by_method = defaultdict(lambda: [0, 0.0])
+        self.statements = Counter()
+        self.statement_methods = defaultdict(set)
+
+    def record(self, method, statement, parameters, duration):
+        key = (statement, repr(parameters))
+        self.count += 1
+        self.duration += duration
+        self.by_method[method][0] += 1
+        self.by_method[method][1] += duration
+        self.statements[key] += 1
+        self.statement_methods[key].add(method)
+
+    def repeated(self):
+        """Return the identical (statement, parameters) pairs that ran more than once."""
+        return {key: count for key, count in self.statements.items() if count > 1}
+
+    def summary(self):
+        methods = ", ".join(
+            "{}: {} / {:.4f}s".format(method, count, duration)
+            for method, (count, duration) in sorted(self.by_method.items(), key=lambda item: -item[1][0])
+        )
+        return "{}: {} queries in {:.4f}s ({})".format(self.name, self.count, self.duration, methods)
+
+    def assert_max_queries(self, maximum):
+        if self.count > maximum:
+            raise AssertionError("Expected at most {} queries, got {}: {}".format(maximum, self.count, self.summary()))
+
+    def assert_no_repeated_queries(self):
+        repeated = self.repeated()
+        if repeated:
+            details = "; ".join(
+                "{}x {} {} from {}".format(count, key[0], key[1], sorted(self.statement_methods[key]))
+                for key, count in repeated.items()
+            )
+            raise AssertionError("Repeated identical queries in {}: {}".format(self.name, details))
+
+
+class QueryProfiler(object):
+    """Attribute the queries executed on an engine to the security manager methods that issued them.
+
+    Queries are only recorded while a unit of work is open, either through :meth:`unit`
+    / :meth:`capture` or between :meth:`begin_unit` and :meth:`end_unit`. Each query is
+    attributed to the innermost method wrapped with :meth:`wrap` that is running on the
+    current thread.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._local = threading.local()
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def close(self):
+        event.remove(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_cursor_execute)
+
+    @property
+    def _methods(self):
+        if not hasattr(self._local, "methods"):
+            self._local.methods = []
+        return self._local.methods
+
+    @property
+    def _reports(self):
+        if not hasattr(self._local, "reports"):
+            self._local.reports = []
+        return self._local.reports
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # Kept on the execution context (or the thread, for the few statements run without one)
+        # so that nothing is left behind when the statement fails and the after event never fires
+        if context is not None:
+            context._query_profiler_start = time.perf_counter()
+        else:
+            self._local.start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_profiler_start", None) if context is not None else self._local.start
+        duration = time.perf_counter() - started
+        method = self._methods[-1] if self._methods else UNATTRIBUTED
+        for report in self._reports:
+            report.record(method, statement, parameters, duration)
+
+    def wrap(self, func, name=None):
+        """Wrap ``func`` so the queries it runs are attributed to ``name``."""
+        name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            self._methods.append(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._methods.pop()
+
+        return wrapper
+
+    def instrument(self, obj, methods, units=()):
+        """Replace ``methods`` on ``obj`` by wrapped versions.
+
+        Methods listed in ``units`` additionally open a unit of work for each call.
+        """
+        for name in methods:
+            if not hasattr(obj, name):
+                continue
+            func = self.wrap(getattr(obj, name), name)
+            if name in units:
+                func = self._wrap_unit(func, name)
+            setattr(obj, name, func)
+
+    def _wrap_unit(self, func, name):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.unit(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def begin_unit(self, name):
+        report = QueryReport(name)
+        self._reports.append(report)
+        return report
+
+    def end_unit(self, *args):
+        """Close the innermost unit of work and log its summary and repeated queries.
+
+        Extra positional arguments are ignored so this can be registered as a Flask
+        ``teardown_request`` handler.
+        """
+        if not self._reports:
+            return None
+        report = self._reports.pop()
+        _logger.info("Query profile for %s", report.summary())
+        for key, count in report.repeated().items():
+            statement, parameters = key
+            _logger.warning(
+                "Repeated query in %s: %d x %s %s from %s",
+                report.name,
+                count,
+                statement,
+                parameters,
+                sorted(report.statement_methods[key]),
+            )
+        return report
+
+    @contextmanager
+    def unit(self, name):
+        report = self.begin_unit(name)
+        try:
+            yield report
+        finally:
+            if self._reports and self._reports[-1] is report:
+                self.end_unit()
+
+    @contextmanager
+    def capture(self, name="capture"):
+        """Collect the queries of a block without logging them, for use in tests.
+
+        Example
+        -------
+        with profiler.capture() as report:
+            security_manager.sync_roles()
+        report.assert_no_repeated_queries()
+        """
+        report = self.begin_unit(name)
+        try:
+            yield report
+        finally:
+            self._reports.remove(report)
@@ -1,12 +1,20 @@
+import itertools
 import json
 import logging
 import os
+import time
 
+import fastjsonschema
 from flask import abort, request
 from flask_appbuilder.security.manager import AUTH_REMOTE_USER
 from flask_appbuilder.security.views import AuthView, expose
 from flask_login import current_user, login_user
 from jwcrypto import jwk, jws, jwt
+from jwcrypto.common import base64url_decode
+from sqlalchemy import event, inspect
+
+from sec_manager.audit import audit_log
+from sec_manager.query_profiler import QueryProfiler
 
 try:
     from airflow.www_rbac.security import EXISTING_ROLES, AirflowSecurityManager
@@ -24,13 +32,93 @@ except ImportError:
 
 _logger: logging.Logger = logging.getLogger(__name__)
 
+# Methods whose metadata-DB queries are attributed separately when query profiling is on
+PROFILED_METHODS = (
+    "before_request",
+    "manage_user_roles",
+    "find_user",
+    "find_role",
+    "find_permission_view_menu",
+    "add_permission_role",
+    "sync_roles",
+)
+
+DEFAULT_MAX_ROLES = 50
+DEFAULT_MAX_CLAIM_LENGTH = 256
+
+DEFAULT_PERMISSION_CACHE_TTL = 30
+# Session.info flag set while a transaction has flushed changes to roles or permissions
+PERMISSIONS_CHANGED = "sec_manager_permissions_changed"
+
+
+def build_claims_schema(max_roles=DEFAULT_MAX_ROLES, max_length=DEFAULT_MAX_CLAIM_LENGTH, check_email=True):
+    """JSON schema of the claims of a Datafabric JWT token.
+
+    The expiry, not-before and audience values are checked by jwcrypto, the schema
+    only makes sure they have the right type.
+
+    Parameters
+    ----------
+    max_roles : int
+        Maximum number of roles a token may carry.
+    max_length : int
+        Maximum length of the user and role names.
+    check_email : bool
+        Check that the email is a valid address. Addresses without a dotted domain,
+        e.g. ``user@localhost``, are rejected.
+
+    Returns
+    -------
+    dict
+    """
+    name = {"type": "string", "minLength": 1, "maxLength": max_length}
+    email = {"type": "string", "maxLength": max_length}
+    if check_email:
+        email["format"] = "email"
+    return {
+        "type": "object",
+        "required": ["sub", "email", "full_name", "roles", "exp", "nbf", "aud"],
+        "properties": {
+            "sub": name,
+            "email": email,
+            "full_name": {"type": ["string", "null"], "maxLength": max_length},
+            "roles": {"type": "array", "maxItems": max_roles, "items": name},
+            # NumericDate, which may be fractional
+            "exp": {"type": "number"},
+            "nbf": {"type": "number"},
+            "aud": {"anyOf": [{"type": "string"}, {"type": "array", "items": {"type": "string"}}]},
+        },
+    }
+
+
+def _unverified_subject(token):
+    """The ``sub`` claim of a compact JWT, read without checking its signature. Only good to
+    tell the clients apart, e.g. to group the audit events of their rejected tokens.
+    """
+    try:
+        claims = json.loads(base64url_decode(token.split(".")[1]))
+    except (IndexError, ValueError):
+        return None
+    subject = claims.get("sub") if isinstance(claims, dict) else None
+    return subject[:DEFAULT_MAX_CLAIM_LENGTH] if isinstance(subject, str) else None
+
 
 class SecurityManagerMixin(object):
     """Flask Class to auto-creates users based
     on the signed JWT token from the Datafabric platform.
     """
 
-    def __init__(self, appbuilder, jwt_signing_cert, allowed_audience, roles_to_manage=None, validity_leeway=60):
+    def __init__(
+        self,
+        appbuilder,
+        jwt_signing_cert,
+        allowed_audience,
+        roles_to_manage=None,
+        validity_leeway=60,
+        profile_queries=False,
+        claims_schema=None,
+        permission_cache_ttl=DEFAULT_PERMISSION_CACHE_TTL,
+    ):
         super().__init__(appbuilder)
         if self.auth_type == AUTH_REMOTE_USER:
             self.authremoteuserview = AuthJwtView
@@ -38,6 +126,50 @@ class SecurityManagerMixin(object):
         self.allowed_audience = allowed_audience
         self.roles_to_manage = roles_to_manage
         self.validity_leeway = validity_leeway
+        self.claims_schema = claims_schema or build_claims_schema()
+        # Compiled once, validating the claims of each request is then a single function call
+        self.validate_claims = fastjsonschema.compile(self.claims_schema)
+        # (expiry, frozenset of (permission, view_menu) pairs) granted to a set of DB roles, keyed by
+        # role ids. The TTL bounds how long a change made by another process (e.g. `airflow sync-perm`
+        # or another webserver worker) can go unnoticed.
+        self.permission_cache_ttl = permission_cache_ttl
+        self._permission_sets = {}
+        self._permission_models = (
+            self.role_model,
+            self.permission_model,
+            self.viewmenu_model,
+            self.permissionview_model,
+        )
+        event.listen(self.get_session, "after_flush", self._permission_models_flushed)
+        event.listen(self.get_session, "after_transaction_end", self._permission_transaction_ended)
+        event.listen(self.get_session, "after_soft_rollback", self._permission_transaction_rolled_back)
+        self.query_profiler = None
+        if profile_queries:
+            self.init_query_profiler()
+
+    def init_query_profiler(self):
+        """Attribute metadata-DB queries to the security manager methods and log,
+        per request and per ``sync_roles`` run, the query counts and any identical
+        query that was repeated.
+
+        Calling it again once the profiler is set up does nothing.
+
+        Returns
+        -------
+        None
+        """
+        if self.query_profiler is not None:
+            return
+        self.query_profiler = QueryProfiler(self.get_session.get_bind())
+        self.query_profiler.instrument(self, PROFILED_METHODS, units=("sync_roles",))
+
+        app = self.appbuilder.get_app
+        # Open the unit ahead of every other hook so the login queries are included
+        app.before_request_funcs.setdefault(None, []).insert(0, self._begin_request_query_unit)
+        app.teardown_request(self.query_profiler.end_unit)
+
+    def _begin_request_query_unit(self):
+        self.query_profiler.begin_unit("request {}".format(request.path))
 
     def before_request(self):
         """Validate  the JWT token provider in the
@@ -54,19 +186,15 @@ class SecurityManagerMixin(object):
         auth_header = request.headers.get("Authorization")
 
         if not auth_header:
-            return abort(403)
+            return self._reject_token("missing_authorization")
 
         if not auth_header.startswith("Bearer "):
-            return abort(403)
+            return self._reject_token("not_bearer")
 
         try:
             token = jwt.JWT(
                 check_claims={
-                    # These must be present - any value
-                    "sub": None,
-                    "email": None,
-                    "full_name": None,
-                    "roles": None,
+                    # The other claims are checked against `claims_schema`.
                     # Use it's built in handling - 60s leeway, 10minutes validity.
                     "exp": None,
                     "nbf": None,
@@ -79,18 +207,20 @@ class SecurityManagerMixin(object):
             token.deserialize(jwt=auth_header[7:], key=self.jwt_signing_cert)
             claims = json.loads(token.claims)
         except jws.InvalidJWSSignature:
-            abort(403)
+            return self._reject_token("invalid_signature")
         except jwt.JWException as e:
-            _logger.debug(e)
-            abort(403)
+            return self._reject_token("invalid_claims", error=str(e))
 
-        if not isinstance(claims["roles"], list):
-            abort(403)
+        try:
+            # Before any DB lookup, e.g. of each of the roles
+            self.validate_claims(claims)
+        except fastjsonschema.JsonSchemaException as e:
+            return self._reject_token("invalid_claims", error=e.message)
 
         if current_user.is_anonymous:
             user = self.find_user(username=claims["sub"])
-            if user is None:
-                _logger.info("Creating airflow user details for %s from JWT", claims["email"])
+            created = user is None
+            if created:
                 user = self.user_model(
                     username=claims["sub"],
                     first_name=claims["full_name"] or claims["email"],
@@ -100,14 +230,13 @@ class SecurityManagerMixin(object):
                     active=True,
                 )
             else:
-                _logger.info("Updating airflow user details for %s from JWT", claims["email"])
-
                 user.username = claims["sub"]
                 user.first_name = claims["full_name"] or claims["email"]
                 user.last_name = ""
                 user.active = True
                 self.manage_user_roles(user, claims["roles"])
 
+            audit_log.emit("login", user=claims["sub"], email=claims["email"], created=created, roles=claims["roles"])
             self.get_session.add(user)
             self.get_session.commit()
             if not login_user(user):
@@ -115,6 +244,27 @@ class SecurityManagerMixin(object):
 
         super().before_request()
 
+    def _reject_token(self, reason, **fields):
+        """Record the rejection of the request's token, once per client address and reason
+        within the audit dedupe window, and answer 403.
+
+        Behind a proxy, the address is the proxy's unless the app trusts its forwarded
+        headers, e.g. with Airflow's ``[webserver] enable_proxy_fix``. The (unverified)
+        subject of the token is only recorded, never trusted to tell clients apart.
+        """
+        auth_header = request.headers.get("Authorization", "")
+        subject = _unverified_subject(auth_header[7:]) if auth_header.startswith("Bearer ") else None
+        audit_log.emit(
+            "token_rejected",
+            dedupe_key=(request.remote_addr, reason),
+            reason=reason,
+            path=request.path,
+            remote_addr=request.remote_addr,
+            sub=subject,
+            **fields,
+        )
+        return abort(403)
+
     def manage_user_roles(self, user, roles):
 
         """Manage the core roles on the user.
@@ -144,9 +294,11 @@ class SecurityManagerMixin(object):
         # iterate and we miss some
         current_roles = list(user.roles)
 
+        removed = []
         for role in current_roles:
             if role.name in roles_to_remove:
                 user.roles.remove(role)
+                removed.append(role.name)
             elif role.name in desired:
                 desired.remove(role.name)
 
@@ -154,6 +306,101 @@ class SecurityManagerMixin(object):
         for role in desired:
             user.roles.append(self.find_role(role))
 
+        if desired or removed:
+            audit_log.emit("role_change", user=user.username, added=sorted(desired), removed=sorted(removed))
+
+    def get_permission_set(self, roles):
+        """Get the (permission, view_menu) pairs granted to ``roles``, loaded with a
+        single query the first time this combination of roles is seen, then cached for
+        ``permission_cache_ttl`` seconds.
+
+        The sets are keyed by role ids, so when ``manage_user_roles`` changes the
+        roles of a user its next access check uses the set of its new roles. Any flushed
+        change to the roles or permissions, e.g. from the Roles edit form, clears the sets.
+
+        Parameters
+        ----------
+        roles : list[Role]
+            Roles stored in the metadata DB, i.e. not builtin roles.
+
+        Returns
+        -------
+        frozenset[tuple[str, str]]
+        """
+        fingerprint = frozenset(role.id for role in roles)
+        # Keep the cache this lookup started with: if it is cleared while we query, our
+        # result goes to the discarded cache instead of bringing back stale grants.
+        permission_sets = self._permission_sets
+        now = time.monotonic()
+        expires_at, permissions = permission_sets.get(fingerprint, (None, None))
+        if permissions is None or expires_at <= now:
+            permissions = self._load_permission_set(fingerprint)
+            permission_sets[fingerprint] = (now + self.permission_cache_ttl, permissions)
+        return permissions
+
+    def _load_permission_set(self, role_ids):
+        if not role_ids:
+            return frozenset()
+        query = (
+            self.get_session.query(self.permission_model.name, self.viewmenu_model.name)
+            .select_from(self.permissionview_model)
+            .join(self.permissionview_model.permission)
+            .join(self.permissionview_model.view_menu)
+            .join(self.permissionview_model.role)
+            .filter(self.role_model.id.in_(role_ids))
+        )
+        return frozenset(query)
+
+    def invalidate_permission_sets(self):
+        """Forget the cached permission sets, after the permissions of a role changed."""
+        self._permission_sets = {}
+
+    def _permission_models_flushed(self, session, flush_context):
+        if any(self._changes_permissions(session, obj) for obj in session.dirty) or any(
+            isinstance(obj, self._permission_models) for obj in itertools.chain(session.new, session.deleted)
+        ):
+            session.info[PERMISSIONS_CHANGED] = True
+            self.invalidate_permission_sets()
+
+    def _changes_permissions(self, session, obj):
+        if isinstance(obj, self.role_model):
+            # Adding a user to a role also marks the role dirty, through the `user` backref
+            return inspect(obj).attrs.permissions.history.has_changes()
+        return isinstance(obj, self._permission_models) and session.is_modified(obj)
+
+    def _permission_transaction_ended(self, session, transaction):
+        # Clear again once the changes are committed (or rolled back), as other sessions may
+        # have cached the previous permissions in the meantime. Savepoints and the subtransactions
+        # of each flush end before that.
+        if transaction.parent is None and session.info.pop(PERMISSIONS_CHANGED, False):
+            self.invalidate_permission_sets()
+
+    def _permission_transaction_rolled_back(self, session, previous_transaction):
+        # Rolling back, even to a savepoint, undoes changes that were flushed and cleared the sets
+        if session.info.get(PERMISSIONS_CHANGED):
+            self.invalidate_permission_sets()
+
+    def _has_view_access(self, user, permission_name, view_name):
+        builtin_roles = getattr(self, "builtin_roles", {})
+        db_roles = []
+        # Builtin (statically configured) roles are checked first, no database query needed
+        for role in user.roles:
+            if role.name in builtin_roles:
+                if self._has_access_builtin_roles(role, permission_name, view_name):
+                    return True
+            else:
+                db_roles.append(role)
+
+        return (permission_name, view_name) in self.get_permission_set(db_roles)
+
+    def add_permission_role(self, role, perm_view):
+        super().add_permission_role(role, perm_view)
+        self.invalidate_permission_sets()
+
+    def del_permission_role(self, role, perm_view):
+        super().del_permission_role(role, perm_view)
+        self.invalidate_permission_sets()
+
 
 class AirflowFabricSecurityManager(SecurityManagerMixin, AirflowSecurityManager):
     """
@@ -186,6 +433,32 @@ class AirflowFabricSecurityManager(SecurityManagerMixin, AirflowSecurityManager)
         except AirflowConfigException:
             pass
 
+        schema_kwargs = {}
+        try:
+            max_roles = conf.get("datafabric", "jwt_max_roles", fallback=None)
+            if max_roles is not None:
+                schema_kwargs["max_roles"] = int(max_roles)
+        except AirflowConfigException:
+            pass
+
+        try:
+            schema_kwargs["check_email"] = conf.getboolean("datafabric", "jwt_check_email", fallback=True)
+        except AirflowConfigException:
+            pass
+        kwargs["claims_schema"] = build_claims_schema(**schema_kwargs)
+
+        try:
+            ttl = conf.get("datafabric", "permission_cache_ttl", fallback=None)
+            if ttl is not None:
+                kwargs["permission_cache_ttl"] = int(ttl)
+        except AirflowConfigException:
+            pass
+
+        try:
+            kwargs["profile_queries"] = conf.getboolean("datafabric", "profile_queries", fallback=False)
+        except AirflowConfigException:
+            pass
+
         super().__init__(**kwargs)
 
     def reload_jwt_signing_cert(self):
@@ -240,6 +513,8 @@ class AirflowFabricSecurityManager(SecurityManagerMixin, AirflowSecurityManager)
         for (view_menu, permission) in [("VariableModelView", "varexport")]:
             self.add_permission_role(self.find_role("Op"), self.find_permission_view_menu(permission, view_menu))
 
+        self.invalidate_permission_sets()
+
 
 class AuthJwtView(AuthView):
     """
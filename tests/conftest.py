@@ -1,6 +1,9 @@
+import json
 import os
 import time
 import uuid
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
 
 import flask_appbuilder
 import pytest
@@ -15,6 +18,16 @@ AUDIENCE = "airflow.example.com"
 os.environ["AIRFLOW__CORE__UNIT_TEST_MODE"] = "True"
 
 
+def pytest_collection_modifyitems(config, items):
+    # Perf tests are slow, only run them when selected with `-m perf`
+    if "perf" in (config.getoption("markexpr") or ""):
+        return
+    skip_perf = pytest.mark.skip(reason="perf test, select it with -m perf")
+    for item in items:
+        if "perf" in item.keywords:
+            item.add_marker(skip_perf)
+
+
 @pytest.fixture(scope="module")
 def app():
     from flask import Flask
@@ -210,3 +223,38 @@ def valid_claims(request):
 def airflow_config(jwt_signing_cert, monkeypatch, allowed_audience):
     monkeypatch.setitem(os.environ, "AIRFLOW__DATAFABRIC__JWT_SIGNING_CERT", jwt_signing_cert)
     monkeypatch.setitem(os.environ, "AIRFLOW__DATAFABRIC__JWT_AUDIENCE", allowed_audience)
+
+
+def make_pod(
+    name, phase="Failed", reason=None, restart_policy="Never", age=0, labels=None, annotations=None, owner=None
+):
+    """Raw JSON of a pod, as returned by the API server."""
+    finished_at = (datetime.now(timezone.utc) - timedelta(seconds=age)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    metadata = {"name": name, "namespace": "awesome-namespace", "creationTimestamp": finished_at}
+    if labels:
+        metadata["labels"] = labels
+    if annotations:
+        metadata["annotations"] = annotations
+    if owner:
+        metadata["ownerReferences"] = [{"apiVersion": "batch/v1", "kind": owner, "name": "owner", "uid": "1"}]
+    status = {
+        "phase": phase,
+        "containerStatuses": [
+            {"name": "base", "state": {"terminated": {"exitCode": 1, "finishedAt": finished_at}}, "restartCount": 0}
+        ],
+    }
+    if reason:
+        status["reason"] = reason
+    return {
+        "metadata": metadata,
+        "spec": {"containers": [{"name": "base", "image": "image"}], "restartPolicy": restart_policy},
+        "status": status,
+    }
+
+
+def pod_list_response(pods, continue_token=None):
+    """Mock of the raw urllib3 response of ``list_namespaced_pod(..., _preload_content=False)``."""
+    response = MagicMock()
+    metadata = {"continue": continue_token} if continue_token else {}
+    response.read.return_value = json.dumps({"kind": "PodList", "metadata": metadata, "items": pods}).encode()
+    return response
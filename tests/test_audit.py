@@ -0,0 +1,135 @@
+import json
+import logging
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from sec_manager.audit import OVERFLOW_DROP, AuditLog
+
+
+class ListWriter(object):
+    def __init__(self, block=None):
+        self.batches = []
+        self.block = block
+
+    def __call__(self, lines):
+        if self.block is not None:
+            self.block.wait()
+        self.batches.append([json.loads(line) for line in lines])
+
+    @property
+    def events(self):
+        return [event for batch in self.batches for event in batch]
+
+
+def test_events_written_as_json_in_batches():
+    writer = ListWriter()
+    audit_log = AuditLog(writer=writer, batch_size=2, flush_interval=0.01)
+
+    for i in range(5):
+        assert audit_log.emit("login", user=f"user{i}")
+    audit_log.flush()
+
+    assert [event["user"] for event in writer.events] == [f"user{i}" for i in range(5)]
+    assert all(event["event"] == "login" and "ts" in event for event in writer.events)
+    assert all(len(batch) <= 2 for batch in writer.batches)
+
+
+def suppressed_counts(events):
+    """Suppressed counts reported with the next event, or in a summary event."""
+    return sum(event.get("suppressed", 0) for event in events if event["event"] == "token_rejected") + sum(
+        event["count"] for event in events if event["event"] == "audit_suppressed"
+    )
+
+
+def test_dedupe_within_window():
+    writer = ListWriter()
+    audit_log = AuditLog(writer=writer, flush_interval=0.01, dedupe_window=60)
+
+    with mock.patch("sec_manager.audit.time.time", return_value=1000.0):
+        assert audit_log.emit("token_rejected", dedupe_key=("1.2.3.4", "invalid_signature"))
+        assert not audit_log.emit("token_rejected", dedupe_key=("1.2.3.4", "invalid_signature"))
+        assert not audit_log.emit("token_rejected", dedupe_key=("1.2.3.4", "invalid_signature"))
+        assert audit_log.emit("token_rejected", dedupe_key=("5.6.7.8", "invalid_signature"))
+    with mock.patch("sec_manager.audit.time.time", return_value=1061.0):
+        assert audit_log.emit("token_rejected", dedupe_key=("1.2.3.4", "invalid_signature"))
+        audit_log.flush()
+
+    assert len([event for event in writer.events if event["event"] == "token_rejected"]) == 3
+    assert suppressed_counts(writer.events) == 2
+
+
+def test_suppressed_count_flushed():
+    writer = ListWriter()
+    audit_log = AuditLog(writer=writer, flush_interval=0.01, dedupe_window=60)
+
+    for _ in range(3):
+        audit_log.emit("token_rejected", dedupe_key=("1.2.3.4", "invalid_signature"), reason="invalid_signature")
+    audit_log.flush()
+
+    summary = writer.events[-1]
+    assert summary["event"] == "audit_suppressed"
+    assert summary["suppressed_event"] == "token_rejected"
+    assert summary["count"] == 2
+    assert summary["reason"] == "invalid_signature"
+
+
+def test_suppressed_count_written_when_window_ends():
+    writer = ListWriter()
+    audit_log = AuditLog(writer=writer, flush_interval=0.01, dedupe_window=0.05)
+
+    for _ in range(3):
+        audit_log.emit("token_rejected", dedupe_key=("1.2.3.4", "invalid_signature"))
+
+    # No further event comes, the writer thread reports the count on its own
+    deadline = time.monotonic() + 5
+    while suppressed_counts(writer.events) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert suppressed_counts(writer.events) == 2
+
+
+def test_dedupe_keys_bounded():
+    writer = ListWriter()
+    audit_log = AuditLog(writer=writer, maxsize=2, flush_interval=0.01, dedupe_window=60)
+
+    for key in ("a", "b", "c", "c"):
+        audit_log.emit("token_rejected", dedupe_key=key)
+        # maxsize bounds the queue too, don't let it fill up
+        audit_log.flush()
+
+    # "c" is not tracked, so not deduplicated
+    assert len(writer.events) == 4
+
+
+def test_default_writer_one_record_per_event(caplog):
+    audit_log = AuditLog(batch_size=10, flush_interval=0.01)
+
+    with caplog.at_level(logging.INFO, logger="sec_manager.audit"):
+        audit_log.emit("login", user="a")
+        audit_log.emit("login", user="b")
+        audit_log.flush()
+
+    assert [json.loads(record.getMessage())["user"] for record in caplog.records] == ["a", "b"]
+
+
+def test_drop_when_full():
+    block = threading.Event()
+    writer = ListWriter(block=block)
+    audit_log = AuditLog(writer=writer, maxsize=2, batch_size=1, flush_interval=0.01, overflow=OVERFLOW_DROP)
+
+    results = [audit_log.emit("pod_deleted", pod=f"pod{i}") for i in range(10)]
+    block.set()
+    audit_log.flush()
+
+    assert not all(results)
+    written = [event for event in writer.events if event["event"] == "pod_deleted"]
+    dropped = sum(event["count"] for event in writer.events if event["event"] == "audit_dropped")
+    assert len(written) == results.count(True)
+    assert dropped == results.count(False)
+
+
+def test_invalid_overflow_policy():
+    with pytest.raises(ValueError):
+        AuditLog(overflow="explode")
@@ -1,28 +1,34 @@
+import sys
+from datetime import datetime, timedelta, timezone
 from unittest import mock
 from unittest.mock import MagicMock
 
 import kubernetes
+import pytest
 
-from sec_manager.pods_cleaner import cleanup, delete_pod
+from sec_manager.kube_client import DEFAULT_REQUEST_TIMEOUT
+from sec_manager.pods_cleaner import CleanupPolicy, _parse_timestamp, cleanup, delete_pod, list_pods, project_pod
+
+from .conftest import make_pod, pod_list_response
 
 
 @mock.patch("kubernetes.client.CoreV1Api.delete_namespaced_pod")
-def test_delete_pod(delete_namespaced_pod):
+def test_delete_pod(delete_namespaced_pod, caplog):
     delete_pod("dummy", "awesome-namespace")
-    delete_namespaced_pod.assert_called_with(body=mock.ANY, name="dummy", namespace="awesome-namespace")
+    delete_namespaced_pod.assert_called_with(
+        body=mock.ANY, name="dummy", namespace="awesome-namespace", _request_timeout=DEFAULT_REQUEST_TIMEOUT
+    )
+    # Visible without any logging configuration
+    assert [record.levelname for record in caplog.records if "dummy" in record.getMessage()] == ["WARNING"]
 
 
 @mock.patch("sec_manager.pods_cleaner.delete_pod")
 @mock.patch("kubernetes.client.CoreV1Api.list_namespaced_pod")
 @mock.patch("kubernetes.config.load_incluster_config")
 def test_cleanup_succeeded_pods(load_incluster_config, list_namespaced_pod, delete_pod):
-    pod1 = MagicMock()
-    pod1.metadata.name = "dummy"
-    pod1.status.phase = "Succeeded"
-    pod1.status.reason = None
-    list_namespaced_pod().items = [pod1]
+    list_namespaced_pod.return_value = pod_list_response([make_pod("dummy", phase="Succeeded")])
     cleanup("awesome-namespace")
-    delete_pod.assert_called_with("dummy", "awesome-namespace")
+    delete_pod.assert_called_with("dummy", "awesome-namespace", api_client=mock.ANY, request_timeout=mock.ANY)
     load_incluster_config.assert_called_once()
 
 
@@ -30,12 +36,7 @@ def test_cleanup_succeeded_pods(load_incluster_config, list_namespaced_pod, dele
 @mock.patch("kubernetes.client.CoreV1Api.list_namespaced_pod")
 @mock.patch("kubernetes.config.load_incluster_config")
 def test_no_cleanup_failed_pods_wo_restart_policy_never(load_incluster_config, list_namespaced_pod, delete_pod):
-    pod1 = MagicMock()
-    pod1.metadata.name = "dummy2"
-    pod1.status.phase = "Failed"
-    pod1.status.reason = None
-    pod1.spec.restart_policy = "Always"
-    list_namespaced_pod().items = [pod1]
+    list_namespaced_pod.return_value = pod_list_response([make_pod("dummy2", restart_policy="Always")])
     cleanup("awesome-namespace")
     delete_pod.assert_not_called()
     load_incluster_config.assert_called_once()
@@ -45,14 +46,9 @@ def test_no_cleanup_failed_pods_wo_restart_policy_never(load_incluster_config, l
 @mock.patch("kubernetes.client.CoreV1Api.list_namespaced_pod")
 @mock.patch("kubernetes.config.load_incluster_config")
 def test_cleanup_failed_pods_w_restart_policy_never(load_incluster_config, list_namespaced_pod, delete_pod):
-    pod1 = MagicMock()
-    pod1.metadata.name = "dummy3"
-    pod1.status.phase = "Failed"
-    pod1.status.reason = None
-    pod1.spec.restart_policy = "Never"
-    list_namespaced_pod().items = [pod1]
+    list_namespaced_pod.return_value = pod_list_response([make_pod("dummy3", restart_policy="Never")])
     cleanup("awesome-namespace")
-    delete_pod.assert_called_with("dummy3", "awesome-namespace")
+    delete_pod.assert_called_with("dummy3", "awesome-namespace", api_client=mock.ANY, request_timeout=mock.ANY)
     load_incluster_config.assert_called_once()
 
 
@@ -60,14 +56,9 @@ def test_cleanup_failed_pods_w_restart_policy_never(load_incluster_config, list_
 @mock.patch("kubernetes.client.CoreV1Api.list_namespaced_pod")
 @mock.patch("kubernetes.config.load_incluster_config")
 def test_cleanup_evicted_pods(load_incluster_config, list_namespaced_pod, delete_pod):
-    pod1 = MagicMock()
-    pod1.metadata.name = "dummy4"
-    pod1.status.phase = "Failed"
-    pod1.status.reason = "Evicted"
-    pod1.spec.restart_policy = "Never"
-    list_namespaced_pod().items = [pod1]
+    list_namespaced_pod.return_value = pod_list_response([make_pod("dummy4", reason="Evicted")])
     cleanup("awesome-namespace")
-    delete_pod.assert_called_with("dummy4", "awesome-namespace")
+    delete_pod.assert_called_with("dummy4", "awesome-namespace", api_client=mock.ANY, request_timeout=mock.ANY)
     load_incluster_config.assert_called_once()
 
 
@@ -76,10 +67,151 @@ def test_cleanup_evicted_pods(load_incluster_config, list_namespaced_pod, delete
 @mock.patch("kubernetes.config.load_incluster_config")
 def test_cleanup_api_exception_continue(load_incluster_config, list_namespaced_pod, delete_pod):
     delete_pod.side_effect = kubernetes.client.rest.ApiException(status=0)
-    pod1 = MagicMock()
-    pod1.metadata.name = "dummy"
-    pod1.status.phase = "Succeeded"
-    pod1.status.reason = None
-    list_namespaced_pod().items = [pod1]
+    list_namespaced_pod.return_value = pod_list_response(
+        [make_pod("dummy", phase="Succeeded"), make_pod("dummy5", phase="Succeeded")]
+    )
     cleanup("awesome-namespace")
+    assert delete_pod.call_count == 2
     load_incluster_config.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "policy, expected",
+    [
+        (CleanupPolicy(), {"old", "recent", "labelled", "job"}),
+        (CleanupPolicy(min_age=3600), {"old"}),
+        (CleanupPolicy(include_labels={"app": "spark"}), {"labelled"}),
+        (CleanupPolicy(exclude_labels={"app": None}), {"old", "recent", "job"}),
+        (CleanupPolicy(exclude_annotations={"keep": "true"}), {"old", "labelled", "job"}),
+        (CleanupPolicy(owner_kinds={"Job"}), {"job"}),
+        (CleanupPolicy(min_age=3600, owner_kinds={"Job"}), set()),
+    ],
+)
+def test_cleanup_policy_filters(policy, expected):
+    now = datetime.now(timezone.utc).timestamp()
+    pods = [
+        make_pod("old", age=3 * 24 * 3600),
+        make_pod("recent", age=60, annotations={"keep": "true"}),
+        make_pod("labelled", age=60, labels={"app": "spark"}),
+        make_pod("job", age=60, owner="Job"),
+        make_pod("running", phase="Running", age=3 * 24 * 3600),
+    ]
+    records = [project_pod(pod, policy.label_keys, policy.annotation_keys) for pod in pods]
+    assert {pod.name for pod in records if policy.match(pod, now)} == expected
+
+
+@mock.patch("sec_manager.pods_cleaner.delete_pod")
+@mock.patch("kubernetes.client.CoreV1Api.list_namespaced_pod")
+@mock.patch("kubernetes.config.load_incluster_config")
+def test_cleanup_max_deletions(load_incluster_config, list_namespaced_pod, delete_pod):
+    list_namespaced_pod.return_value = pod_list_response([make_pod(f"dummy{i}", phase="Succeeded") for i in range(5)])
+    cleanup("awesome-namespace", policy=CleanupPolicy(max_deletions=2))
+    assert delete_pod.call_count == 2
+
+
+@mock.patch("sec_manager.pods_cleaner.delete_pod")
+@mock.patch("kubernetes.client.CoreV1Api.list_namespaced_pod")
+@mock.patch("kubernetes.config.load_incluster_config")
+def test_cleanup_dry_run_index(load_incluster_config, list_namespaced_pod, delete_pod):
+    list_namespaced_pod.return_value = pod_list_response(
+        [
+            make_pod("succeeded1", phase="Succeeded", age=60),
+            make_pod("succeeded2", phase="Succeeded", age=2 * 3600),
+            make_pod("evicted", reason="Evicted", age=10 * 24 * 3600),
+            make_pod("failed", age=90),
+            make_pod("running", phase="Running"),
+        ]
+    )
+    index = cleanup("awesome-namespace", dry_run=True)
+    delete_pod.assert_not_called()
+    assert index == {
+        ("succeeded", "<1h"): ["succeeded1"],
+        ("succeeded", "1h-6h"): ["succeeded2"],
+        ("evicted", ">7d"): ["evicted"],
+        ("failed", "<1h"): ["failed"],
+    }
+
+
+@mock.patch("sec_manager.pods_cleaner.delete_pod")
+@mock.patch("kubernetes.client.CoreV1Api.list_namespaced_pod")
+@mock.patch("kubernetes.config.load_incluster_config")
+def test_cleanup_dry_run_max_deletions(load_incluster_config, list_namespaced_pod, delete_pod):
+    list_namespaced_pod.return_value = pod_list_response([make_pod(f"dummy{i}", phase="Succeeded") for i in range(5)])
+    index = cleanup("awesome-namespace", policy=CleanupPolicy(max_deletions=2), dry_run=True)
+    delete_pod.assert_not_called()
+    assert index == {("succeeded", "<1h"): ["dummy0", "dummy1"]}
+
+
+def test_evicted_pod_age_from_conditions():
+    now = datetime.now(timezone.utc)
+    pod = make_pod("evicted", reason="Evicted", age=60)
+    # Evicted after running for three days, without any terminated container
+    del pod["status"]["containerStatuses"]
+    pod["status"]["startTime"] = (now - timedelta(days=3)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    pod["status"]["conditions"] = [
+        {"type": "PodScheduled", "lastTransitionTime": (now - timedelta(days=3)).strftime("%Y-%m-%dT%H:%M:%SZ")},
+        {"type": "Ready", "lastTransitionTime": (now - timedelta(seconds=60)).strftime("%Y-%m-%dT%H:%M:%SZ")},
+    ]
+
+    assert CleanupPolicy(min_age=3600).match(project_pod(pod), now.timestamp()) is None
+
+
+def test_list_pods_pages_and_projection():
+    core_v1 = MagicMock()
+    core_v1.list_namespaced_pod.side_effect = [
+        pod_list_response([make_pod("page1", labels={"app": "spark", "tier": "batch"})], continue_token="next"),
+        pod_list_response([make_pod("page2", annotations={"keep": "true", "big": "x" * 10000})]),
+    ]
+    policy = CleanupPolicy(include_labels={"app": None}, exclude_annotations={"keep": None})
+
+    records = list(list_pods(core_v1, "awesome-namespace", policy, page_size=1))
+
+    assert [record.name for record in records] == ["page1", "page2"]
+    assert records[0].labels == {"app": "spark"}
+    assert records[1].annotations == {"keep": "true"}
+    assert records[0].restart_policy == "never"
+    assert core_v1.list_namespaced_pod.call_args_list == [
+        mock.call("awesome-namespace", limit=1, _preload_content=False, _request_timeout=DEFAULT_REQUEST_TIMEOUT),
+        mock.call(
+            "awesome-namespace",
+            limit=1,
+            _preload_content=False,
+            _request_timeout=DEFAULT_REQUEST_TIMEOUT,
+            _continue="next",
+        ),
+    ]
+    # Only the small projection is kept, not the raw pod or a V1Pod model
+    assert sum(sys.getsizeof(field) for field in records[1]) < sys.getsizeof("x" * 10000)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("2021-06-01T12:00:00Z", 1622548800.0),
+        ("2021-06-01T12:00:00.5Z", 1622548800.5),
+        ("2021-06-01T12:00:00.123456789Z", 1622548800.123456),
+        ("2021-06-01T14:00:00+02:00", 1622548800.0),
+        ("yesterday", None),
+        ("", None),
+        (None, None),
+    ],
+)
+def test_parse_timestamp(value, expected):
+    parsed = _parse_timestamp(value)
+    if expected is None:
+        assert parsed is None
+    else:
+        assert parsed == pytest.approx(expected)
+
+
+def test_list_pods_unparseable_timestamp():
+    core_v1 = MagicMock()
+    pod = make_pod("odd")
+    pod["status"]["containerStatuses"][0]["state"]["terminated"]["finishedAt"] = "not a date"
+    pod["metadata"]["creationTimestamp"] = "not a date either"
+    core_v1.list_namespaced_pod.return_value = pod_list_response([pod, make_pod("dummy")])
+
+    records = list(list_pods(core_v1, "awesome-namespace", CleanupPolicy()))
+
+    assert [record.name for record in records] == ["odd", "dummy"]
+    assert records[0].completed_at is None
@@ -0,0 +1,117 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import pytest
+
+from sec_manager.kube_client import KEEPALIVE_SOCKET_OPTIONS, create_api_client
+from sec_manager.pods_cleaner import cleanup
+
+from .conftest import make_pod
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    """Serves a pod listing for one namespace and records every call and client connection."""
+
+    daemon_threads = True
+
+    def __init__(self, pods):
+        super().__init__(("127.0.0.1", 0), FakeApiHandler)
+        self.pods = pods
+        self.calls = []
+        self.client_ports = set()
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body):
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _record(self):
+        self.server.calls.append((self.command, self.path.split("?")[0], self.headers.get("Authorization")))
+        self.server.client_ports.add(self.client_address[1])
+
+    def do_GET(self):
+        self._record()
+        self._reply({"kind": "PodList", "apiVersion": "v1", "metadata": {}, "items": self.server.pods})
+
+    def do_DELETE(self):
+        self._record()
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self._reply({"kind": "Status", "apiVersion": "v1", "status": "Success"})
+
+
+@pytest.fixture
+def fake_api_server():
+    server = FakeApiServer(
+        [
+            make_pod("succeeded1", phase="Succeeded"),
+            make_pod("succeeded2", phase="Succeeded"),
+            make_pod("evicted", reason="Evicted"),
+            make_pod("running", phase="Running"),
+        ]
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def kubeconfig(tmp_path, fake_api_server):
+    path = tmp_path / "kubeconfig"
+    server = f"http://127.0.0.1:{fake_api_server.server_port}"
+    path.write_text(
+        json.dumps(
+            {
+                "apiVersion": "v1",
+                "kind": "Config",
+                "clusters": [{"name": "fake", "cluster": {"server": server}}],
+                "users": [{"name": "fake", "user": {"token": "s3cr3t"}}],
+                "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake"}}],
+                "current-context": "fake",
+            }
+        )
+    )
+    return str(path)
+
+
+def test_create_api_client_from_kubeconfig(kubeconfig, fake_api_server):
+    api_client = create_api_client(kubeconfig=kubeconfig, pool_maxsize=7)
+
+    assert api_client.configuration.host == f"http://127.0.0.1:{fake_api_server.server_port}"
+    assert api_client.configuration.connection_pool_maxsize == 7
+    assert api_client.rest_client.pool_manager.connection_pool_kw["maxsize"] == 7
+    assert api_client.rest_client.pool_manager.connection_pool_kw["socket_options"] == KEEPALIVE_SOCKET_OPTIONS
+
+
+@mock.patch("kubernetes.config.load_incluster_config")
+def test_create_api_client_in_cluster(load_incluster_config):
+    api_client = create_api_client(keepalive=False)
+
+    load_incluster_config.assert_called_once_with(client_configuration=api_client.configuration)
+    assert "socket_options" not in api_client.rest_client.pool_manager.connection_pool_kw
+
+
+def test_cleanup_against_fake_api_server(kubeconfig, fake_api_server):
+    cleanup("awesome-namespace", api_client=create_api_client(kubeconfig=kubeconfig))
+
+    assert fake_api_server.calls == [
+        ("GET", "/api/v1/namespaces/awesome-namespace/pods", "Bearer s3cr3t"),
+        ("DELETE", "/api/v1/namespaces/awesome-namespace/pods/succeeded1", "Bearer s3cr3t"),
+        ("DELETE", "/api/v1/namespaces/awesome-namespace/pods/succeeded2", "Bearer s3cr3t"),
+        ("DELETE", "/api/v1/namespaces/awesome-namespace/pods/evicted", "Bearer s3cr3t"),
+    ]
+    # The listing and the deletions all reused the same pooled connection
+    assert len(fake_api_server.client_ports) == 1
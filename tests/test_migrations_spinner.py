@@ -1,8 +1,20 @@
+import argparse
+import json
+import time
 from unittest import mock
 
 import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
 
-from sec_manager.migrations_spinner import spinner
+from sec_manager.migrations_spinner import (
+    Readiness,
+    load_script_directory,
+    parse_databases,
+    revision_distance,
+    spinner,
+    wait_for_database,
+)
 
 
 @mock.patch("alembic.runtime.migration.MigrationContext.get_current_heads")
@@ -20,3 +32,119 @@ def test_spinner_one_sec_timeout(get_heads, get_current_heads):
     get_heads.return_value = ["10000000"]
     with pytest.raises(TimeoutError):
         spinner(timeout=1)
+
+
+@mock.patch("alembic.runtime.migration.MigrationContext.get_current_heads")
+@mock.patch("alembic.script.base.ScriptDirectory.get_heads")
+def test_spinner_ready_file(get_heads, get_current_heads, tmp_path):
+    get_heads.return_value = ["00000000"]
+    get_current_heads.return_value = ["00000000"]
+    ready_file = tmp_path / "ready"
+    spinner(timeout=0, ready_file=str(ready_file))
+    assert json.loads(ready_file.read_text()) == {"airflow": {"ready": True, "pending_revisions": 0}}
+
+
+@mock.patch("alembic.runtime.migration.MigrationContext.get_current_heads")
+@mock.patch("alembic.script.base.ScriptDirectory.get_heads")
+def test_spinner_multiple_databases_timeout(get_heads, get_current_heads, tmp_path):
+    get_current_heads.return_value = ["00000000"]
+    get_heads.return_value = ["10000000"]
+    ready_file = tmp_path / "ready"
+    with pytest.raises(TimeoutError, match="airflow.*tenant|tenant.*airflow"):
+        spinner(
+            timeout=1, databases={"tenant": "sqlite://"}, ready_file=str(ready_file), migrations={"tenant": "airflow"}
+        )
+    assert not ready_file.exists()
+
+
+@mock.patch("alembic.runtime.migration.MigrationContext.get_current_heads")
+@mock.patch("alembic.script.base.ScriptDirectory.get_heads")
+def test_spinner_database_without_migrations(get_heads, get_current_heads, tmp_path):
+    # A results backend has no alembic_version table, it only needs to accept connections
+    get_heads.return_value = ["00000000"]
+    get_current_heads.return_value = ["00000000"]
+    ready_file = tmp_path / "ready"
+    with mock.patch("sqlalchemy.engine.base.Engine.dispose") as dispose:
+        spinner(timeout=0, databases={"results": "sqlite://"}, ready_file=str(ready_file))
+    dispose.assert_called_once_with()
+    assert json.loads(ready_file.read_text()) == {
+        "airflow": {"ready": True, "pending_revisions": 0},
+        "results": {"ready": True, "pending_revisions": None},
+    }
+
+
+@mock.patch("alembic.runtime.migration.MigrationContext.get_current_heads")
+@mock.patch("alembic.script.base.ScriptDirectory.get_heads")
+def test_spinner_database_unreachable(get_heads, get_current_heads, tmp_path):
+    get_heads.return_value = ["00000000"]
+    get_current_heads.return_value = ["00000000"]
+    url = "sqlite:///" + str(tmp_path / "missing" / "results.db")
+    with pytest.raises(TimeoutError, match="results does not accept connections"):
+        spinner(timeout=1, databases={"results": url})
+
+
+def test_spinner_migrations_for_unknown_database():
+    with pytest.raises(ValueError, match="unknown"):
+        spinner(timeout=0, migrations={"tenant": "airflow"})
+
+
+SCRIPT = """revision = {revision!r}
+down_revision = {down_revision!r}
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    pass
+
+
+def downgrade():
+    pass
+"""
+
+
+@pytest.fixture
+def multi_head_script(tmp_path):
+    # a -> b -> c, and b -> d on another branch: heads are c and d
+    (tmp_path / "versions").mkdir()
+    for revision, down_revision in (("a", None), ("b", "a"), ("c", "b"), ("d", "b")):
+        script = SCRIPT.format(revision=revision, down_revision=down_revision)
+        (tmp_path / "versions" / "{}.py".format(revision)).write_text(script)
+    return load_script_directory(str(tmp_path))
+
+
+def test_revision_distance(multi_head_script):
+    heads = set(multi_head_script.get_heads())
+    assert heads == {"c", "d"}
+    assert revision_distance(multi_head_script, heads, {"c"}) == 1
+    assert revision_distance(multi_head_script, heads, {"a"}) == 3
+    assert revision_distance(multi_head_script, heads, set()) == 4
+    assert revision_distance(multi_head_script, heads, {"z"}) is None
+
+
+@mock.patch("alembic.runtime.migration.MigrationContext.get_current_heads")
+def test_wait_for_database_unreachable_at_first(get_current_heads):
+    get_current_heads.return_value = ["00000000"]
+    script_ = mock.MagicMock()
+    script_.get_heads.return_value = ["00000000"]
+    engine = create_engine("sqlite://")
+    refused = OperationalError("SELECT 1", {}, Exception("could not connect to server"))
+    readiness = Readiness(["tenant"])
+
+    with mock.patch.object(engine, "connect", side_effect=[refused, engine.connect()]) as connect:
+        wait_for_database("tenant", engine, script_, time.monotonic() + 5, readiness, interval=0)
+
+    assert connect.call_count == 2
+    assert readiness.status() == {"tenant": {"ready": True, "pending_revisions": 0}}
+
+
+def test_parse_databases():
+    assert parse_databases(["tenant_a=sqlite://", "results=postgresql://u:p@h/db?a=b"]) == {
+        "tenant_a": "sqlite://",
+        "results": "postgresql://u:p@h/db?a=b",
+    }
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_databases(["no-url"])
+    assert parse_databases(["tenant_a=/opt/migrations"], value_name="SCRIPT_LOCATION") == {
+        "tenant_a": "/opt/migrations"
+    }
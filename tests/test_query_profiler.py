@@ -0,0 +1,124 @@
+import logging
+
+import pytest
+from flask import url_for
+from sqlalchemy.exc import OperationalError
+
+from sec_manager.query_profiler import UNATTRIBUTED, QueryProfiler
+from sec_manager.security import PROFILED_METHODS
+
+
+@pytest.fixture
+def profiler(run_in_transaction, db):
+    # Emit the SAVEPOINTs of the test transaction before we start counting
+    run_in_transaction.get_session.connection()
+    profiler = QueryProfiler(db.engine)
+    yield profiler
+    profiler.close()
+
+
+class TestQueryProfiler:
+    def test_attributes_queries_to_methods(self, appbuilder, profiler, monkeypatch):
+        sm = appbuilder.sm
+        monkeypatch.setattr(sm, "find_role", profiler.wrap(sm.find_role, "find_role"))
+
+        with profiler.capture() as report:
+            sm.find_role("Op")
+            sm.find_user(username="nobody")
+
+        assert report.count == 2
+        assert report.by_method["find_role"][0] == 1
+        assert report.by_method[UNATTRIBUTED][0] == 1
+        report.assert_max_queries(2)
+        with pytest.raises(AssertionError):
+            report.assert_max_queries(1)
+
+    def test_flags_repeated_queries(self, appbuilder, profiler):
+        sm = appbuilder.sm
+
+        with profiler.capture() as report:
+            sm.find_role("Op")
+            sm.find_role("Viewer")
+
+        report.assert_no_repeated_queries()
+
+        with profiler.capture() as report:
+            sm.find_role("Op")
+            sm.find_role("Op")
+
+        assert list(report.repeated().values()) == [2]
+        with pytest.raises(AssertionError, match="Repeated identical queries"):
+            report.assert_no_repeated_queries()
+
+    def test_failed_statement_leaves_nothing_behind(self, appbuilder, profiler):
+        connection = appbuilder.get_session.connection()
+        with pytest.raises(OperationalError):
+            connection.execute("SELECT * FROM no_such_table")
+        with profiler.capture() as report:
+            connection.execute("SELECT 1")
+
+        assert report.count == 1
+        assert not [key for key in connection.info if key.startswith("query_profiler")]
+
+    def test_no_recording_outside_unit(self, appbuilder, profiler):
+        appbuilder.sm.find_role("Op")
+
+        assert profiler.end_unit() is None
+
+    def test_nested_units(self, appbuilder, profiler):
+        with profiler.unit("outer") as outer:
+            appbuilder.sm.find_role("Op")
+            with profiler.unit("inner") as inner:
+                appbuilder.sm.find_role("Viewer")
+
+        assert inner.count == 1
+        assert outer.count == 2
+
+
+@pytest.fixture
+def profiled_sm(appbuilder, monkeypatch):
+    # The security manager is shared by the whole module: undo everything init_query_profiler
+    # does to it, i.e. the wrapped methods, the request hooks and the engine listeners.
+    sm = appbuilder.sm
+    app = appbuilder.get_app
+    for name in PROFILED_METHODS:
+        if hasattr(sm, name):
+            monkeypatch.setitem(sm.__dict__, name, getattr(sm, name))
+    for funcs in (app.before_request_funcs, app.teardown_request_funcs):
+        monkeypatch.setitem(funcs, None, list(funcs.get(None, [])))
+    monkeypatch.setattr(sm, "query_profiler", None)
+
+    sm.init_query_profiler()
+    yield sm
+    sm.query_profiler.close()
+
+
+@pytest.mark.usefixtures("client_class", "run_in_transaction")
+class TestSecurityManagerQueryProfiling:
+    def test_init_is_idempotent(self, appbuilder, profiled_sm):
+        app = appbuilder.get_app
+        profiler = profiled_sm.query_profiler
+        find_role = profiled_sm.find_role
+        hooks = (len(app.before_request_funcs[None]), len(app.teardown_request_funcs[None]))
+
+        profiled_sm.init_query_profiler()
+
+        assert profiled_sm.query_profiler is profiler
+        assert profiled_sm.find_role is find_role
+        assert (len(app.before_request_funcs[None]), len(app.teardown_request_funcs[None])) == hooks
+
+    def test_request_profile_logged(self, appbuilder, profiled_sm, signed_jwt, valid_claims, caplog):
+
+        jwt = signed_jwt(valid_claims)
+        resp = self.client.get(url_for("home"), headers=[("Authorization", "Bearer " + jwt)])
+
+        assert resp.status_code == 200
+        # pytest-flask keeps a request context pushed, so teardown_request only runs at the end of
+        # the test. Close the request unit ourselves.
+        with caplog.at_level(logging.INFO, logger="sec_manager.query_profiler"):
+            report = profiled_sm.query_profiler.end_unit()
+
+        assert report.name == "request /"
+        assert report.by_method["find_user"][0] >= 1
+        assert report.by_method["find_role"][0] == len(valid_claims["roles"])
+        assert "Query profile for request /" in caplog.text
@@ -1,10 +1,12 @@
 import os
 import time
 
+import fastjsonschema
 import pytest
 from flask import g, url_for
 
-from sec_manager.security import AirflowFabricSecurityManager
+from sec_manager.query_profiler import QueryProfiler
+from sec_manager.security import DEFAULT_MAX_ROLES, AirflowFabricSecurityManager, build_claims_schema
 
 from .conftest import AUDIENCE
 
@@ -47,6 +49,43 @@ class TestAstroSecurityManagerMixin:
         resp = self.client.get(url_for("home"), headers=[("Authorization", "Bearer " + jwt)])
         assert resp.status_code == 403
 
+    @pytest.mark.parametrize(
+        "overrides",
+        [
+            {"roles": ["Op"] * (DEFAULT_MAX_ROLES + 1)},
+            {"roles": ["Op", 42]},
+            {"roles": [""]},
+            {"sub": 42},
+            {"sub": "a" * 1000},
+            {"email": "not an email"},
+            {"full_name": ["Air", "flower"]},
+        ],
+    )
+    def test_signed_jwt_claims_rejected_by_schema(self, appbuilder, signed_jwt, valid_claims, overrides, mocker):
+        find_role = mocker.spy(appbuilder.sm, "find_role")
+        valid_claims.update(overrides)
+
+        jwt = signed_jwt(valid_claims)
+        resp = self.client.get(url_for("home"), headers=[("Authorization", "Bearer " + jwt)])
+        assert resp.status_code == 403
+        find_role.assert_not_called()
+
+    def test_signed_jwt_without_full_name(self, appbuilder, signed_jwt, valid_claims):
+        valid_claims["full_name"] = None
+
+        jwt = signed_jwt(valid_claims)
+        resp = self.client.get(url_for("home"), headers=[("Authorization", "Bearer " + jwt)])
+        assert resp.status_code == 200
+        assert g.user.first_name == valid_claims["email"]
+
+    def test_signed_jwt_fractional_dates(self, appbuilder, signed_jwt, valid_claims):
+        valid_claims["nbf"] = valid_claims["nbf"] - 0.5
+        valid_claims["exp"] = valid_claims["exp"] + 0.5
+
+        jwt = signed_jwt(valid_claims)
+        resp = self.client.get(url_for("home"), headers=[("Authorization", "Bearer " + jwt)])
+        assert resp.status_code == 200
+
     def test_signed_jwt_valid_claims_new_user(self, appbuilder, signed_jwt, valid_claims):
         jwt = signed_jwt(valid_claims)
         resp = self.client.get(url_for("home"), headers=[("Authorization", "Bearer " + jwt)])
@@ -127,3 +166,184 @@ class TestAirflowAstroSecurityManger:
         sm = AirflowFabricSecurityManager(appbuilder)
 
         assert sm.validity_leeway == leeway
+
+    def test_check_email(self, appbuilder, monkeypatch):
+        monkeypatch.setitem(os.environ, "AIRFLOW__DATAFABRIC__JWT_CHECK_EMAIL", "False")
+        sm = AirflowFabricSecurityManager(appbuilder)
+
+        assert "format" not in sm.claims_schema["properties"]["email"]
+
+    def test_max_roles(self, appbuilder, monkeypatch):
+        monkeypatch.setitem(os.environ, "AIRFLOW__DATAFABRIC__JWT_MAX_ROLES", "3")
+        sm = AirflowFabricSecurityManager(appbuilder)
+
+        assert sm.claims_schema["properties"]["roles"]["maxItems"] == 3
+
+
+@pytest.mark.usefixtures("run_in_transaction")
+class TestPermissionSets:
+    @pytest.fixture
+    def permission_view(self, appbuilder):
+        # add_permission_view_menu commits several times. Build the rows ourselves instead
+        sm = appbuilder.sm
+        pv = sm.permissionview_model(
+            permission=sm.permission_model(name="can_test"), view_menu=sm.viewmenu_model(name="TestView")
+        )
+        appbuilder.session.add(pv)
+        appbuilder.session.flush()
+        return pv
+
+    @pytest.fixture
+    def grant(self, appbuilder):
+        def grant_factory(role, pv, revoke=False):
+            # add/del_permission_role commit. We don't want that
+            txn = appbuilder.session.begin_nested()
+            if revoke:
+                appbuilder.sm.del_permission_role(role, pv)
+            else:
+                appbuilder.sm.add_permission_role(role, pv)
+            if txn.is_active:
+                txn.commit()
+
+        return grant_factory
+
+    def test_has_view_access_cached(self, appbuilder, db, user, role, permission_view, grant):
+        sm = appbuilder.sm
+        grant(role("Tester"), permission_view)
+        user.roles.append(role("Tester"))
+
+        assert sm._has_view_access(user, "can_test", "TestView")
+
+        profiler = QueryProfiler(db.engine)
+        try:
+            with profiler.capture() as report:
+                assert sm._has_view_access(user, "can_test", "TestView")
+                assert not sm._has_view_access(user, "can_other", "TestView")
+        finally:
+            profiler.close()
+        report.assert_max_queries(0)
+
+    def test_permission_change_invalidates(self, appbuilder, user, role, permission_view, grant):
+        sm = appbuilder.sm
+        user.roles.append(role("Tester"))
+        assert not sm._has_view_access(user, "can_test", "TestView")
+
+        grant(role("Tester"), permission_view)
+        assert sm._has_view_access(user, "can_test", "TestView")
+
+        grant(role("Tester"), permission_view, revoke=True)
+        assert not sm._has_view_access(user, "can_test", "TestView")
+
+    def test_role_change_uses_new_permission_set(self, appbuilder, user, role, permission_view, grant):
+        sm = appbuilder.sm
+        grant(role("Tester"), permission_view)
+        assert not sm._has_view_access(user, "can_test", "TestView")
+
+        sm.manage_user_roles(user, ["Tester"])
+        assert sm._has_view_access(user, "can_test", "TestView")
+
+        sm.manage_user_roles(user, ["Admin"])
+        assert not sm._has_view_access(user, "can_test", "TestView")
+
+    def test_orm_permission_change_invalidates(self, appbuilder, user, role, permission_view, grant):
+        # The Roles edit form changes `role.permissions` without going through the security manager
+        sm = appbuilder.sm
+        tester = role("Tester")
+        grant(tester, permission_view)
+        user.roles.append(tester)
+        assert sm._has_view_access(user, "can_test", "TestView")
+
+        tester.permissions.remove(permission_view)
+        appbuilder.session.flush()
+        assert not sm._has_view_access(user, "can_test", "TestView")
+
+    def test_role_deletion_invalidates(self, appbuilder, role, permission_view, grant):
+        sm = appbuilder.sm
+        tester = role("Tester")
+        grant(tester, permission_view)
+        assert sm.get_permission_set([tester])
+
+        appbuilder.session.delete(tester)
+        appbuilder.session.flush()
+        assert sm._permission_sets == {}
+
+    def test_permission_sets_expire(self, appbuilder, role, mocker):
+        sm = appbuilder.sm
+        monotonic = mocker.patch("sec_manager.security.time.monotonic", return_value=1000.0)
+        load = mocker.spy(sm, "_load_permission_set")
+
+        sm.get_permission_set([role("Tester")])
+        sm.get_permission_set([role("Tester")])
+        assert load.call_count == 1
+
+        monotonic.return_value += sm.permission_cache_ttl
+        sm.get_permission_set([role("Tester")])
+        assert load.call_count == 2
+
+    def test_invalidation_during_load_not_cached(self, appbuilder, role, monkeypatch):
+        sm = appbuilder.sm
+        load = sm._load_permission_set
+
+        def load_then_invalidate(role_ids):
+            permissions = load(role_ids)
+            # e.g. another thread committing a permission change while we were querying
+            sm.invalidate_permission_sets()
+            return permissions
+
+        monkeypatch.setattr(sm, "_load_permission_set", load_then_invalidate)
+        sm.get_permission_set([role("Tester")])
+        assert sm._permission_sets == {}
+
+
+@pytest.mark.usefixtures("client_class", "run_in_transaction")
+class TestAuditEvents:
+    def test_token_rejected(self, appbuilder, mocker):
+        emit = mocker.patch("sec_manager.security.audit_log.emit")
+        resp = self.client.get(url_for("home"), headers=[("Authorization", "Basic Zm9vOmJhcg==")])
+        assert resp.status_code == 403
+        emit.assert_called_once_with(
+            "token_rejected",
+            dedupe_key=(mocker.ANY, "not_bearer"),
+            reason="not_bearer",
+            path="/",
+            remote_addr=mocker.ANY,
+            sub=None,
+        )
+
+    def test_token_rejected_subject_recorded(self, appbuilder, signed_jwt, valid_claims, mocker):
+        # The unverified subject is recorded but clients are only told apart by address
+        emit = mocker.patch("sec_manager.security.audit_log.emit")
+        for subject in ("alice", "bob"):
+            valid_claims.update(sub=subject, roles="NotAList")
+            jwt = signed_jwt(valid_claims)
+            resp = self.client.get(url_for("home"), headers=[("Authorization", "Bearer " + jwt)])
+            assert resp.status_code == 403
+
+        assert [call.kwargs["dedupe_key"] for call in emit.call_args_list] == [
+            ("127.0.0.1", "invalid_claims"),
+            ("127.0.0.1", "invalid_claims"),
+        ]
+        assert [call.kwargs["sub"] for call in emit.call_args_list] == ["alice", "bob"]
+
+    def test_login_and_role_change(self, appbuilder, user, signed_jwt, valid_claims, mocker):
+        emit = mocker.patch("sec_manager.security.audit_log.emit")
+        valid_claims["sub"] = user.username
+
+        jwt = signed_jwt(valid_claims)
+        resp = self.client.get(url_for("home"), headers=[("Authorization", "Bearer " + jwt)])
+        assert resp.status_code == 200
+        emit.assert_any_call("role_change", user=user.username, added=["Op"], removed=["Admin"])
+        emit.assert_any_call(
+            "login", user=user.username, email=valid_claims["email"], created=False, roles=valid_claims["roles"]
+        )
+
+
+@pytest.mark.parametrize("check_email, valid", [(True, False), (False, True)])
+def test_claims_schema_check_email(valid_claims, check_email, valid):
+    validate = fastjsonschema.compile(build_claims_schema(check_email=check_email))
+    valid_claims["email"] = "user@localhost"
+    if valid:
+        validate(valid_claims)
+    else:
+        with pytest.raises(fastjsonschema.JsonSchemaException):
+            validate(valid_claims)